@@ -1,47 +1,83 @@
 import streamlit as st
-import fitz  # PyMuPDF
 import gc
+import hashlib
 import os
+import shutil
 import tempfile
 import threading
+import time
 import pandas as pd
 import zipfile
-from io import BytesIO
+from collections import OrderedDict
+
+from compressor import GRAYSCALE_BELOW_QUALITY, compress_pdf, start_pool
+
+# Fork the render workers before this run touches MuPDF (see compressor.py)
+start_pool()
 
 # --- STABILITY CONFIGURATION ---
 if 'process_lock' not in st.session_state:
     st.session_state.process_lock = threading.Lock()
 
+if 'result_cache' not in st.session_state:
+    st.session_state.result_cache = OrderedDict()
+
 MAX_FILE_SIZE_MB = 500 
+METHODS = {"Auto": "auto", "Recompress Images": "images", "Rasterize Pages": "rasterize"}
+RESULT_CACHE_SIZE = 4
+RESULT_DIR = os.path.join(tempfile.gettempdir(), "pdf_compress_results")
+RESULT_DIR_MAX_MB = 2048  # all sessions' cached results together
+RESULT_MAX_AGE_S = 60 * 60  # untouched this long: the session is gone
 
 def purge():
     gc.collect()
 
-def fast_compress(input_path, dpi, quality):
-    doc = fitz.open(input_path)
-    out_doc = fitz.open()
-    
-    for page in doc:
-        # zoom = dpi / 72. 72 is the internal PDF point system.
-        zoom = dpi / 72
-        mat = fitz.Matrix(zoom, zoom)
-        
-        # Capture the page as an image
-        pix = page.get_pixmap(matrix=mat, colorspace=fitz.csRGB)
-        img_data = pix.tobytes("jpg", jpg_quality=quality)
-        
-        # Re-insert into a clean PDF page
-        new_page = out_doc.new_page(width=page.rect.width, height=page.rect.height)
-        new_page.insert_image(page.rect, stream=img_data)
-        
-        pix = None # Release image from RAM
-
-    out_path = tempfile.mktemp(suffix=".pdf")
-    out_doc.save(out_path, garbage=4, deflate=True)
-    
-    doc.close()
-    out_doc.close()
-    return out_path
+# --- RESULT CACHE ---
+# Same bytes + same settings give the same output, so re-clicking Compress
+# (e.g. after toggling a setting back) reuses the PDF already on disk.
+def result_key(path, *settings):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(4 * 1024 * 1024), b""):
+            h.update(chunk)
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+def trim_result_cache():
+    cache = st.session_state.result_cache
+    while len(cache) > RESULT_CACHE_SIZE:
+        _, old_path = cache.popitem(last=False)
+        if os.path.exists(old_path): os.remove(old_path)
+
+# Sessions end without any hook to clean up after them, so every cached
+# result lives in one shared directory that is swept by age and total size.
+def store_result(path):
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    dest = os.path.join(RESULT_DIR, os.path.basename(path))
+    shutil.move(path, dest)
+    return dest
+
+def sweep_result_dir():
+    if not os.path.isdir(RESULT_DIR):
+        return
+
+    entries = []
+    total = 0
+    for entry in os.scandir(RESULT_DIR):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue  # removed by another session's sweep
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total += stat.st_size
+
+    # Oldest first: drop stale results, then more until the cap is met
+    now = time.time()
+    for mtime, size, path in sorted(entries):
+        if now - mtime < RESULT_MAX_AGE_S and total <= RESULT_DIR_MAX_MB * 1024 * 1024:
+            break
+        if os.path.exists(path): os.remove(path)
+        total -= size
 
 # --- UI ---
 st.set_page_config(page_title="Custom PDF Compressor", page_icon="⚙️")
@@ -52,6 +88,15 @@ st.info(f"Max Capacity: {MAX_FILE_SIZE_MB}MB per batch. Processing is queued.")
 # --- DUAL SLIDER SIDEBAR ---
 st.sidebar.header("Compression Tuning")
 
+# Method: what gets re-encoded
+user_method = st.sidebar.radio(
+    "Compression Method",
+    list(METHODS),
+    help="Recompress Images keeps text and vector graphics as they are and only shrinks embedded pictures. "
+         "Rasterize Pages turns every page into a JPEG: smaller for scans, but text is no longer selectable. "
+         "Auto recompresses images when they make up almost all of the file and rasterizes otherwise."
+)
+
 # Slider 1: Resolution (DPI)
 user_dpi = st.sidebar.slider(
     "Resolution (DPI)", 
@@ -72,10 +117,30 @@ user_quality = st.sidebar.slider(
     help="Lower quality increases 'graininess' in photos but saves a lot of space."
 )
 
+# Toggle: Grayscale rendering
+user_grayscale = st.sidebar.checkbox(
+    "Grayscale",
+    value=False,
+    help="Drops color. One channel instead of three: much smaller files for text documents."
+)
+
+# Rasterized pages switch to grayscale at very low quality (compressor.py)
+if user_quality < GRAYSCALE_BELOW_QUALITY and not user_grayscale and METHODS[user_method] != "images":
+    st.sidebar.warning(f"Quality below {GRAYSCALE_BELOW_QUALITY}%: rasterized pages are rendered in grayscale.")
+
+# Toggle: Switch colorless documents to grayscale on their own
+user_auto_grayscale = st.sidebar.checkbox(
+    "Auto Grayscale",
+    value=True,
+    disabled=user_grayscale,
+    help="Checks every page at low resolution and uses grayscale when none of them contain color."
+)
+
 # Technical Status Update
 st.sidebar.divider()
 st.sidebar.write(f"**Target Resolution:** {user_dpi} DPI")
 st.sidebar.write(f"**Compression Level:** {100 - user_quality}% Reduction")
+st.sidebar.write(f"**Color Mode:** {'Grayscale' if user_grayscale else 'Auto' if user_auto_grayscale else 'RGB'}")
 
 
 
@@ -99,21 +164,37 @@ if up_files:
                     status_box.info(f"Working on: **{up_file.name}**")
                     
                     with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f_in:
-                        f_in.write(up_file.getbuffer())
+                        shutil.copyfileobj(up_file, f_in, length=4 * 1024 * 1024)
                         f_in_path = f_in.name
                     
                     comp_path = None
                     try:
-                        # Use the custom slider values here
-                        comp_path = fast_compress(f_in_path, user_dpi, user_quality)
-                        
-                        with open(comp_path, "rb") as f:
-                            final_pdf_bytes = f.read()
+                        key = result_key(
+                            f_in_path, user_method, user_dpi, user_quality,
+                            user_grayscale, user_auto_grayscale,
+                        )
+                        comp_path = st.session_state.result_cache.get(key)
+
+                        if comp_path and os.path.exists(comp_path):
+                            st.session_state.result_cache.move_to_end(key)
+                            os.utime(comp_path)  # still in use; keep it out of the sweep
+                        else:
+                            # Use the custom slider values here
+                            comp_path = compress_pdf(
+                                f_in_path, user_dpi, user_quality, user_grayscale, METHODS[user_method],
+                                on_progress=lambda done, total: progress_bar.progress(
+                                    (idx + done / total) / len(up_files)
+                                ),
+                                auto_grayscale=user_auto_grayscale,
+                            )
+                            comp_path = store_result(comp_path)
+                            st.session_state.result_cache[key] = comp_path
                         
-                        processed_results.append((final_pdf_bytes, up_file.name))
+                        # Results stay on disk until the download is built
+                        processed_results.append((comp_path, up_file.name))
                         
                         orig_s = os.path.getsize(f_in_path) / (1024 * 1024)
-                        new_s = len(final_pdf_bytes) / (1024 * 1024)
+                        new_s = os.path.getsize(comp_path) / (1024 * 1024)
                         
                         report_data.append({
                             "File Name": up_file.name,
@@ -127,29 +208,43 @@ if up_files:
                     
                     finally:
                         if os.path.exists(f_in_path): os.remove(f_in_path)
-                        if comp_path and os.path.exists(comp_path): os.remove(comp_path)
-                        purge()
                         progress_bar.progress((idx + 1) / len(up_files))
 
+                # Pixmaps are freed by refcount inside the workers; one
+                # collection per batch is enough for the parent.
+                purge()
                 status_box.success("✅ Process complete!")
                 st.table(pd.DataFrame(report_data))
 
-                if len(processed_results) == 1:
-                    st.download_button(
-                        label="📥 Download PDF",
-                        data=processed_results[0][0],
-                        file_name=f"compressed_{processed_results[0][1]}",
-                        mime="application/pdf"
-                    )
-                else:
-                    zip_buffer = BytesIO()
-                    with zipfile.ZipFile(zip_buffer, "w") as zf:
-                        for data, name in processed_results:
-                            zf.writestr(f"compressed_{name}", data)
-                    
-                    st.download_button(
-                        label="📥 Download All (ZIP)",
-                        data=zip_buffer.getvalue(),
-                        file_name="compressed_files.zip",
-                        mime="application/zip"
-                    )
+                try:
+                    if len(processed_results) == 1:
+                        comp_path, name = processed_results[0]
+                        with open(comp_path, "rb") as f_pdf:
+                            st.download_button(
+                                label="📥 Download PDF",
+                                data=f_pdf,
+                                file_name=f"compressed_{name}",
+                                mime="application/pdf"
+                            )
+                    else:
+                        # The PDFs are already deflated, so store them as-is and
+                        # build the archive on disk rather than in RAM.
+                        zip_path = tempfile.mktemp(suffix=".zip")
+                        try:
+                            with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_STORED) as zf:
+                                for comp_path, name in processed_results:
+                                    zf.write(comp_path, arcname=f"compressed_{name}")
+
+                            with open(zip_path, "rb") as f_zip:
+                                st.download_button(
+                                    label="📥 Download All (ZIP)",
+                                    data=f_zip,
+                                    file_name="compressed_files.zip",
+                                    mime="application/zip"
+                                )
+                        finally:
+                            if os.path.exists(zip_path): os.remove(zip_path)
+                finally:
+                    # Results now live in the cache; only drop what no longer fits
+                    trim_result_cache()
+                    sweep_result_dir()
@@ -0,0 +1,457 @@
+import functools
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from itertools import chain, repeat
+
+import fitz  # PyMuPDF
+from PIL import Image, ImageChops
+
+# Workers are forked so they inherit the loaded modules. While a script
+# run is in progress Streamlit installs app.py as sys.modules["__main__"],
+# so "spawn" and "forkserver" workers would bootstrap by re-running app.py
+# as __mp_main__ (and hit its start_pool() call mid-bootstrap).
+_MP_CONTEXT = multiprocessing.get_context("fork") if os.name == "posix" else None
+
+# Damaged PDFs can make MuPDF print an error line per object it repairs;
+# keep stderr quiet (the messages stay in fitz.TOOLS.mupdf_warnings()).
+fitz.TOOLS.mupdf_display_errors(False)
+
+# --- WORKER SIDE ---
+# Each task is a run of pages from one file: the worker opens the PDF,
+# renders those pages and closes it again, so no worker keeps an upload
+# open (and its disk blocks alive) after app.py has deleted it. Only JPEG
+# bytes travel back to the parent.
+STORE_SHRINK_EVERY = 10  # pages rendered per worker between store flushes
+
+def _encode_jpeg(pix, quality):
+    # Pillow's encoder can build optimized Huffman tables, which MuPDF's
+    # built-in JPEG writer does not; same quality, a few percent fewer bytes.
+    # frombuffer over samples_mv reads MuPDF's pixel buffer in place rather
+    # than copying it into a bytes object first; pix must outlive img.
+    mode = "L" if pix.n == 1 else "RGB"
+    img = Image.frombuffer(mode, (pix.width, pix.height), pix.samples_mv, "raw", mode, 0, 1)
+    buf = BytesIO()
+    # 4:2:0 chroma subsampling, stated explicitly rather than left to the
+    # libjpeg default; ignored for grayscale. Progressive scans usually
+    # come out a few percent smaller than baseline, as for embedded images.
+    img.save(buf, format="JPEG", quality=quality, optimize=True, progressive=True, subsampling=2)
+    return buf.getvalue()
+
+MAX_STRIP_PIXELS = 4_000_000  # ~12 MB of RGB per rendered strip
+
+@functools.lru_cache(maxsize=None)
+def _render_setup(dpi, grayscale):
+    # Constant for a whole document, so built once per worker, not per page.
+    # zoom = dpi / 72. 72 is the internal PDF point system.
+    zoom = dpi / 72
+    mat = fitz.Matrix(zoom, zoom)
+
+    # Grayscale keeps one byte per pixel instead of three all the way
+    # through the JPEG encoder.
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    return mat, colorspace
+
+def _page_strips(page, dpi):
+    # Big pages (A3 scans, posters) are rendered in horizontal strips so the
+    # pixmap in memory stays around MAX_STRIP_PIXELS whatever the page size.
+    rect = page.rect
+    zoom = dpi / 72
+    # Same rounding MuPDF applies to the pixmap, so the strip arithmetic
+    # matches the pixels that actually come back
+    width_px = max(1, (rect * fitz.Matrix(zoom, zoom)).irect.width)
+    if page.rotation or width_px * rect.height * zoom <= MAX_STRIP_PIXELS:
+        return [rect]
+
+    # Strip edges fall on whole pixel rows so the pieces butt up cleanly
+    strip_h = max(1, MAX_STRIP_PIXELS // width_px) / zoom
+    strips = []
+    y = rect.y0
+    while y < rect.y1:
+        strips.append(fitz.Rect(rect.x0, y, rect.x1, min(y + strip_h, rect.y1)))
+        y += strip_h
+    return strips
+
+def _render_page(page, dpi, quality, grayscale):
+    mat, colorspace = _render_setup(dpi, grayscale)
+
+    parts = []
+    for clip in _page_strips(page, dpi):
+        # Capture the page (or one strip of it) as an image
+        # alpha=False is already the default; spelled out because
+        # _encode_jpeg picks its mode from pix.n and expects no alpha plane
+        pix = page.get_pixmap(matrix=mat, colorspace=colorspace, clip=clip, alpha=False)
+        parts.append((tuple(clip), pix.width, pix.height, _encode_jpeg(pix, quality)))
+
+        del pix # Release image from RAM right away; no gc pass needed
+    return parts
+
+def _render_pages(input_path, page_indexes, dpi, quality, grayscale):
+    rendered = []
+    with fitz.open(input_path) as doc:
+        for count, page_index in enumerate(page_indexes, 1):
+            rendered.append(_render_page(doc[page_index], dpi, quality, grayscale))
+
+            # MuPDF keeps decoded images and fonts in its own store, which
+            # neither del nor gc.collect() reaches; flush it now and then so
+            # worker RSS stays flat on long documents.
+            if count % STORE_SHRINK_EVERY == 0:
+                fitz.TOOLS.store_shrink(100)
+
+    fitz.TOOLS.store_shrink(100)  # nothing cached for this file is needed again
+    return rendered
+
+GRAY_PROBE_DPI = 32  # just enough pixels to tell color from gray
+
+def _pages_are_gray(input_path, page_indexes):
+    # Tiny RGB render of each page, stopping at the first one with color;
+    # if every pixel has R == G == B there is no color worth carrying three
+    # channels for.
+    zoom = GRAY_PROBE_DPI / 72
+    mat = fitz.Matrix(zoom, zoom)
+    gray = True
+    with fitz.open(input_path) as doc:
+        for page_index in page_indexes:
+            pix = doc[page_index].get_pixmap(matrix=mat, colorspace=fitz.csRGB, alpha=False)
+            # Same in-place view of the samples as _encode_jpeg
+            img = Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", 0, 1)
+            r, g, b = img.split()
+            if ImageChops.difference(r, g).getbbox() or ImageChops.difference(g, b).getbbox():
+                gray = False
+                break
+
+    fitz.TOOLS.store_shrink(100)  # images decoded for the probe are not needed again
+    return gray
+
+# --- PARENT SIDE ---
+# One pool for the whole server process, shared by every file and session,
+# so workers are forked once instead of per file. The lock keeps two
+# sessions starting at the same moment from each forking a pool.
+#
+# Forking a multi-threaded process is only safe if no child needs state
+# another thread was changing at fork time. Workers only run the executor
+# loop and open their own documents, and PyMuPDF installs no MuPDF locks a
+# child could inherit locked. But other sessions' script threads do run
+# MuPDF in this process, and the children inherit MuPDF's global context
+# (its store of decoded images and fonts). So the pool is forked as early
+# as possible: app.py calls start_pool() at the top of the script, and with
+# "fork" the executor creates every worker on its first submit. The first
+# pool is therefore forked before any session has opened a PDF. Only a
+# replacement for a broken pool can be forked while another session is
+# mid-document. That needs a worker to have died first, and it is the
+# case this design accepts.
+_pool = None
+_pool_lock = threading.Lock()
+
+def start_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=_MP_CONTEXT)
+            _pool.submit(int)  # forks the workers now
+        return _pool
+
+def _discard_pool(pool):
+    # A worker died (usually killed for memory), which breaks the pool for
+    # good; shut it down and drop it so the next file starts a fresh one.
+    # Another session may already have replaced it, so only clear our own.
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _page_batches(page_indexes):
+    # About four tasks per worker: few enough that each opens the PDF only
+    # a handful of times, enough to keep every worker busy to the end.
+    size = max(1, len(page_indexes) // ((os.cpu_count() or 1) * 4))
+    return [page_indexes[i:i + size] for i in range(0, len(page_indexes), size)]
+
+def _can_copy_page(doc, page, dpi, grayscale):
+    infos = page.get_image_info(xrefs=True)
+
+    # Text/vector-only pages are already compact, and copying keeps the
+    # text sharp and selectable instead of turning it into a JPEG.
+    if not infos:
+        return not grayscale and len(page.get_text()) > 50
+
+    # A page that is just one JPEG already at (or below) the target
+    # resolution gains nothing from being rendered and re-encoded.
+    if len(infos) != 1:
+        return False
+
+    info = infos[0]
+    if grayscale and info["colorspace"] != 1:
+        return False
+
+    xref = info["xref"]
+    if not xref or doc.xref_get_key(xref, "Filter") != ("name", "/DCTDecode"):
+        return False
+
+    bbox = fitz.Rect(info["bbox"])
+    if bbox.is_empty:
+        return False
+
+    image_dpi = max(info["width"] / bbox.width, info["height"] / bbox.height) * 72
+    return image_dpi <= dpi * 1.1
+
+GRAYSCALE_BELOW_QUALITY = 40  # chroma is quantized to almost nothing under this
+
+# grayscale is the user's choice and also rules out copying color pages;
+# render_gray only switches the rendered pages to one channel.
+def fast_compress(input_path, dpi, quality, grayscale=False, on_progress=None, render_gray=False):
+    # At very low quality the color channels of a rendered page carry little
+    # beyond blotches; dropping them saves their encode time and bytes.
+    # Copied pages keep their color.
+    render_gray = render_gray or quality < GRAYSCALE_BELOW_QUALITY
+
+    # Normally a no-op; after a broken pool this forks the replacement
+    # before this file is opened.
+    pool = start_pool()
+
+    doc = fitz.open(input_path)
+    out_doc = fitz.open()
+
+    page_count = len(doc)
+    progress_step = max(1, page_count // 100)
+
+    copy_pages = {page.number for page in doc if _can_copy_page(doc, page, dpi, grayscale)}
+    render_indexes = [i for i in range(page_count) if i not in copy_pages]
+
+    try:
+        rendered = chain.from_iterable(pool.map(
+            _render_pages, repeat(input_path), _page_batches(render_indexes),
+            repeat(dpi), repeat(quality), repeat(grayscale or render_gray),
+        ))
+
+        # map() yields in page order, so pages are re-inserted in sequence
+        # while the workers keep rendering ahead.
+        for page in doc:
+            if page.number in copy_pages:
+                out_doc.insert_pdf(doc, from_page=page.number, to_page=page.number)
+            else:
+                new_page = out_doc.new_page(width=page.rect.width, height=page.rect.height)
+                # Passing the known size spares MuPDF a decode of each JPEG
+                # just to read its dimensions. Each clip is exactly the area
+                # its pixels were rendered from, so the image is stretched to
+                # fill it; keeping proportions would let pixel rounding open
+                # thin gaps at the strip seams.
+                for clip, width, height, img_data in next(rendered):
+                    new_page.insert_image(
+                        fitz.Rect(clip), stream=img_data,
+                        width=width, height=height, alpha=0, keep_proportion=False,
+                    )
+
+            # Report roughly once per percent; a UI update per page costs
+            # more than the page itself on long documents.
+            done = page.number + 1
+            if on_progress and (done % progress_step == 0 or done == page_count):
+                on_progress(done, page_count)
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+
+    # Object streams pack the many small page/xobject dictionaries into one
+    # compressed stream, trimming the file on top of the image savings.
+    # Rendered pages are unique JPEGs with nothing to dedupe, so the
+    # stream-comparing garbage=4 pass only pays off when copied pages may
+    # bring in duplicate fonts.
+    out_path = tempfile.mktemp(suffix=".pdf")
+    out_doc.save(out_path, garbage=4 if copy_pages else 1, deflate=True, use_objstms=True)
+
+    doc.close()
+    out_doc.close()
+    return out_path
+
+# --- IMAGE RECOMPRESSION ---
+# Leaves text and vector content alone and only re-encodes the embedded
+# raster images, downscaling any that are stored above the target DPI.
+# PyMuPDF calls stay on the calling thread; the Pillow decode/resize/encode
+# in between runs on a thread pool, since Pillow releases the GIL there.
+MIN_IMAGE_PIXELS = 256 * 256  # icons and small logos are not worth touching
+
+def _image_job(doc, img, shown_width, dpi, quality, grayscale):
+    xref, _, width, height, bpc = img[:5]
+    if width * height < MIN_IMAGE_PIXELS or bpc == 1:
+        return None
+
+    base_image = doc.extract_image(xref)
+    if not base_image or base_image["colorspace"] not in (1, 3):
+        return None  # CMYK and friends are easy to get wrong; leave them be
+    mode = "L" if grayscale or base_image["colorspace"] == 1 else "RGB"
+
+    # Largest size the image is shown at anywhere in the document, in
+    # target pixels
+    target_size = (width, height)
+    if shown_width:
+        target_w = max(1, int(shown_width / 72 * dpi))
+        if width > target_w:
+            target_size = (target_w, max(1, round(height * target_w / width)))
+
+    # A JPEG that needs no downscaling or color conversion and is already
+    # about as dense as our re-encode would be can only lose quality by
+    # going round again.
+    if (base_image["ext"] == "jpeg" and target_size == (width, height)
+            and (mode == "RGB" or base_image["colorspace"] == 1)
+            and len(base_image["image"]) <= width * height * quality / 200):
+        return None
+
+    return xref, base_image["image"], mode, target_size
+
+def _reencode_image(image_bytes, mode, target_size, quality):
+    try:
+        pil_img = Image.open(BytesIO(image_bytes))
+        # JPEG sources decode straight at 1/2, 1/4 or 1/8 scale when that is
+        # still at least the target size, skipping most of the IDCT work.
+        pil_img.draft(mode, target_size)
+        pil_img = pil_img.convert(mode)
+    except (OSError, Image.DecompressionBombError):
+        # Undecodable or absurdly large images are left as they are
+        return None
+
+    if pil_img.width > target_size[0]:
+        factor = pil_img.width // target_size[0]
+        if factor >= 2:
+            # Big reductions: integer box-average down to within 2x of the
+            # target, then one bilinear step. After JPEG quantization this
+            # looks the same as Lanczos at a fraction of the cost.
+            pil_img = pil_img.reduce(factor)
+            pil_img = pil_img.resize(target_size, Image.Resampling.BILINEAR)
+        else:
+            pil_img = pil_img.resize(target_size, Image.Resampling.LANCZOS)
+
+    img_buf = BytesIO()
+    pil_img.save(img_buf, format="JPEG", quality=quality, optimize=True, progressive=True, subsampling=2)
+    return img_buf.getvalue(), pil_img.size, pil_img.mode
+
+def _replace_image(doc, xref, result):
+    if result is None:
+        return
+    new_data, (width, height), mode = result
+
+    # Only swap the stream in when it actually got smaller
+    if len(new_data) >= len(doc.xref_stream_raw(xref)):
+        return
+
+    doc.update_stream(xref, new_data, compress=False)
+    doc.xref_set_key(xref, "Filter", "/DCTDecode")
+    doc.xref_set_key(xref, "DecodeParms", "null")
+    doc.xref_set_key(xref, "Decode", "null")
+    doc.xref_set_key(xref, "Width", str(width))
+    doc.xref_set_key(xref, "Height", str(height))
+    doc.xref_set_key(xref, "BitsPerComponent", "8")
+    doc.xref_set_key(xref, "ColorSpace", "/DeviceGray" if mode == "L" else "/DeviceRGB")
+
+def _recompress_with_pillow(doc, dpi, quality, grayscale, on_progress):
+    # Logos and letterheads repeat on every page but are one shared xref;
+    # re-encoding it once updates every page that uses it. Walk all pages
+    # first so each image is sized for the largest place it is shown, not
+    # just the first.
+    images = {}
+    shown_widths = {}
+    for page in doc:
+        for img in page.get_images(full=True):
+            xref = img[0]
+            images.setdefault(xref, img)
+            # Measure along the image's own x axis: the bbox width is the
+            # wrong side for rotated placements such as landscape scans
+            for _, matrix in page.get_image_rects(xref, transform=True):
+                shown_width = math.hypot(matrix.a, matrix.b)
+                shown_widths[xref] = max(shown_widths.get(xref, 0), shown_width)
+
+    image_count = len(images)
+    progress_step = max(1, image_count // 100)
+
+    workers = os.cpu_count() or 1
+    # Bound the images in flight so a huge PDF is not pulled into RAM at once
+    max_pending = workers * 2
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for done, (xref, img) in enumerate(images.items(), 1):
+            job = _image_job(doc, img, shown_widths.get(xref), dpi, quality, grayscale)
+            if job is not None:
+                xref, image_bytes, mode, target_size = job
+                pending.append((xref, pool.submit(_reencode_image, image_bytes, mode, target_size, quality)))
+
+                if len(pending) > max_pending:
+                    xref, future = pending.popleft()
+                    _replace_image(doc, xref, future.result())
+
+            if on_progress and (done % progress_step == 0 or done == image_count):
+                on_progress(done, image_count)
+
+        while pending:
+            xref, future = pending.popleft()
+            _replace_image(doc, xref, future.result())
+
+def recompress_images(input_path, dpi, quality, grayscale=False, on_progress=None):
+    doc = fitz.open(input_path)
+
+    _recompress_with_pillow(doc, dpi, quality, grayscale, on_progress)
+
+    out_path = tempfile.mktemp(suffix=".pdf")
+    # The original text, fonts and vector content survive here, so spending
+    # maximum zlib effort on their streams is worth it.
+    doc.save(out_path, garbage=4, deflate=True, clean=True, use_objstms=True, compression_effort=100)
+
+    doc.close()
+    return out_path
+
+# --- ENTRY POINT ---
+IMAGE_HEAVY_SHARE = 0.9  # image streams' share of the file that counts as "scan-like"
+
+def _image_byte_share(doc, input_path):
+    # Sums the stored /Length of every image stream without reading any data
+    image_bytes = 0
+    for xref in range(1, doc.xref_length()):
+        if not doc.xref_is_image(xref):
+            continue
+        kind, value = doc.xref_get_key(xref, "Length")
+        if kind == "xref":
+            # Ghostscript and others write every /Length as an indirect
+            # object ("12 0 R"); the number lives in that object.
+            value = doc.xref_object(int(value.split()[0])).strip()
+            kind = "int" if value.isdigit() else kind
+        if kind == "int":
+            image_bytes += int(value)
+    return image_bytes / max(1, os.path.getsize(input_path))
+
+def _looks_grayscale(input_path, page_count):
+    # Probed on the worker pool in page batches, so the check costs about
+    # one low-resolution render per page spread over every core. Leaving
+    # map() early on a color page cancels the batches not yet started.
+    pool = start_pool()
+    try:
+        return all(pool.map(_pages_are_gray, repeat(input_path), _page_batches(range(page_count))))
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise
+
+def compress_pdf(input_path, dpi, quality, grayscale=False, method="auto", on_progress=None,
+                 auto_grayscale=False):
+    colorless = False
+    if auto_grayscale and not grayscale:
+        with fitz.open(input_path) as doc:
+            page_count = len(doc)
+        colorless = _looks_grayscale(input_path, page_count)
+
+    if method == "auto":
+        # Image-dominated files (scans, photo books) only need their image
+        # objects re-encoded, which skips rendering entirely; anything else
+        # is rasterized.
+        with fitz.open(input_path) as doc:
+            share = _image_byte_share(doc, input_path)
+        method = "images" if share >= IMAGE_HEAVY_SHARE else "rasterize"
+
+    # A colorless document loses nothing by going gray, and its text-only
+    # pages can still be copied as they are.
+    if method == "images":
+        return recompress_images(input_path, dpi, quality, grayscale or colorless, on_progress)
+    return fast_compress(input_path, dpi, quality, grayscale, on_progress, render_gray=colorless)